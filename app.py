@@ -1,13 +1,69 @@
 # app.py — Firmify (Enhetsregisteret søk) med segment-filtre inkl. Fysisk & Topprestasjon
+import functools
 import io
 import math
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+import orjson
 import requests
 import pandas as pd
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 ENHETS_API = "https://data.brreg.no/enhetsregisteret/api/enheter"
+# v2-profilen utelater verbose _links/embedded-metadata — vesentlig færre bytes per side.
+# Feltene vi bruker (naeringskode1-3, forretningsadresse, institusjonellSektorkode,
+# hjemmeside) finnes også i profilen.
+ENHETS_ACCEPT = "application/vnd.brreg.enhetsregisteret.enhet.v2+json"
 PAGE_SIZE = 200  # fast side-størrelse mot API
 
+# Regnskapsregisteret: URL-varianter observert i dokumentasjon/felt — prøves i rekkefølge.
+# (base, param): param=None betyr orgnr som path-segment, ellers som query-parameter.
+REGN_ENDPOINT_CANDIDATES = [
+    ("https://data.brreg.no/regnskapsregisteret/regnskap", None),
+    ("https://data.brreg.no/regnskapsregisteret/api/regnskap", None),
+    ("https://data.brreg.no/regnskapsregisteret/regnskap", "orgnr"),
+]
+REGN_MAX_WORKERS = 16  # parallelle regnskaps-oppslag over den delte sesjonen
+
+# Disk-cache for regnskaps-JSON: overlever app-restart, TTL 24 t
+# (regnskapstall er stabile innenfor et regnskapsår).
+REGN_CACHE_DIR = Path(os.getenv("FIRMIFY_CACHE_DIR", "~/.firmify/cache")).expanduser() / "regn"
+REGN_CACHE_TTL = 86400  # sekunder
+PAGE_WORKERS = 8       # parallelle side-hentinger mot Enhetsregisteret
+
+# Bakgrunnstråder for serialisering (xlsx er CPU-tung); hovedtråden er likevel
+# idle mens brukeren ser på tabellen
+SERIALIZE_POOL = ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource(show_spinner=False)
+def get_session() -> requests.Session:
+    """Delt sesjon: keep-alive + connection pooling mot Brreg, med retry/backoff.
+
+    st.cache_resource gir én pool delt på tvers av reruns og sesjoner —
+    trådsikker for GET, så side- og regnskaps-arbeiderne deler den også.
+    """
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+    ))
+    # br krever brotli-pakken; requests/urllib3 dekomprimerer transparent
+    s.headers.update({
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, br",
+        "User-Agent": "firmify/1.0",
+    })
+    return s
+
 st.set_page_config(page_title="Firmify – Livity", layout="wide")
 st.title("Firmify for Livity 𐂐")
 
@@ -27,73 +83,121 @@ FYSISK_NACE_PREFIXES = (
 # Topprestasjon: finans (64–66), advokat/regnskap (69), management consulting (70)
 TOPP_NACE_PREFIXES = ["64", "65", "66", "69", "70"]
 
-PUBLIC_ORGFORM = {
+# Segmentnavn → prefiks-liste, i visningsrekkefølge (matcher checkbox-rekkefølgen)
+SEGMENTS = [
+    ("Kontor", KONTOR_NACE_PREFIXES),
+    ("Helse/omsorg", HELSE_NACE_PREFIXES),
+    ("Fysisk", FYSISK_NACE_PREFIXES),
+    ("Topprestasjon", TOPP_NACE_PREFIXES),
+]
+
+# Alle prefiksene er to tegn, så hele segment-klassifiseringen er ett
+# tabell-oppslag per kode: kode[:2] → bitmaske der bit i = SEGMENTS[i].
+# Én pass over kodene erstatter fire separate per-segment-skann.
+NACE2_BITS: dict[str, int] = {}
+for _i, (_, _prefixes) in enumerate(SEGMENTS):
+    for _pfx in _prefixes:
+        NACE2_BITS[_pfx] = NACE2_BITS.get(_pfx, 0) | (1 << _i)
+
+PUBLIC_ORGFORM = frozenset({
     # Vanlige offentlige orgformer (ikke uttømmende)
     "KOMM", "FYLKE", "KF", "FKF", "IKS", "STAT", "SF", "ORGL"
-}
+})
 
 # --- Sidebar: filtre -----------------------------------------------------------
-with st.sidebar:
-    st.header("Filtre")
-
-    # A) Kommuner (valg + egne koder)
-    KOMMUNE_CHOICES = {
-        "Oslo (0301)": "0301",
-        "Bergen (4601)": "4601",
-        "Trondheim (5001)": "5001",
-        "Stavanger (1103)": "1103",
-        "Drammen (3005)": "3005",
-        "Bærum (3024)": "3024",
-    }
-    valgt_kommuner_navn = st.multiselect(
-        "Velg kommuner",
-        options=list(KOMMUNE_CHOICES.keys()),
-        default=["Oslo (0301)"],
-        help="Huk av én eller flere kommuner."
-    )
-    valgt_kommunenr = [KOMMUNE_CHOICES[n] for n in valgt_kommuner_navn]
-    andre_kommuner_raw = st.text_input("Egne kommunenummer (komma-separert)", value="")
-    if andre_kommuner_raw.strip():
+KOMMUNE_CHOICES = {
+    "Oslo (0301)": "0301",
+    "Bergen (4601)": "4601",
+    "Trondheim (5001)": "5001",
+    "Stavanger (1103)": "1103",
+    "Drammen (3005)": "3005",
+    "Bærum (3024)": "3024",
+}
+
+@st.fragment
+def render_sidebar() -> None:
+    """Alle filter-widgetene samlet i ett fragment.
+
+    Å pirke i et filter rerunner da bare sidebaren — ikke hele skriptet med
+    resultattabell og nedlastingsknapper. Verdiene publiseres via
+    st.session_state["filters"] og leses av kjøre-blokken når brukeren trykker
+    «Hent selskaper».
+    """
+    with st.sidebar:
+        st.header("Filtre")
+
+        # A) Kommuner (valg + egne koder)
+        valgt_kommuner_navn = st.multiselect(
+            "Velg kommuner",
+            options=list(KOMMUNE_CHOICES.keys()),
+            default=["Oslo (0301)"],
+            help="Huk av én eller flere kommuner."
+        )
+        valgt_kommunenr = [KOMMUNE_CHOICES[n] for n in valgt_kommuner_navn]
+        andre_kommuner_raw = st.text_input("Egne kommunenummer (komma-separert)", value="")
         ekstra = [k.strip() for k in andre_kommuner_raw.split(",") if k.strip()]
-        kommunenummer = list(dict.fromkeys(valgt_kommunenr + ekstra))
-    else:
-        kommunenummer = valgt_kommunenr
-
-    # B) Ansatte-intervall
-    col1, col2 = st.columns(2)
-    with col1:
-        min_ansatte = st.number_input("Min ansatte", min_value=0, value=0, step=1)
-    with col2:
-        max_ansatte = st.number_input("Max ansatte", min_value=0, value=999_999, step=10)
-
-    # C) Segment (bransjeklynger via NACE)
-    st.subheader("Segment (bransjeklynger)")
-    use_kontor = st.checkbox("Kontor (IT/rådgivning/regnskap/salg)", value=False)
-    use_helse = st.checkbox("Helse & omsorg (skole/helse/barnehage)", value=False)
-    use_fysisk = st.checkbox("Fysiske virksomheter (bygg/industri/transport)", value=False)
-    use_topp = st.checkbox("Topprestasjon (advokat/konsulent/finans)", value=False)
-
-    # D) Sektor
-    st.subheader("Sektor")
-    sektor_priv = st.checkbox("Privat", value=True)
-    sektor_off = st.checkbox("Offentlig", value=True)
-
-    # E) Nettsidekrav
-    only_with_site = st.checkbox("Kun selskaper med nettside", value=True)
-
-    st.divider()
-    st.subheader("Antall og oppførsel")
-    ønsket_antall = st.number_input("Hvor mange selskaper vil du hente?", min_value=1, value=500, step=50)
-    shuffle_every_run = st.checkbox("Nye (tilfeldige) selskaper ved hver kjøring", value=True)
+        # Kanonisk form (sortert tuple): samme utvalg gir samme cache-nøkkel uansett
+        # rekkefølge/duplikater, så fetch_page-cachen treffer på tvers av reruns.
+        # Én set-bygging i én pass — ingen mellomliggende lister eller union-kopier.
+        kommunenummer = tuple(sorted({*valgt_kommunenr, *ekstra}))
+
+        # B) Ansatte-intervall
+        col1, col2 = st.columns(2)
+        with col1:
+            min_ansatte = st.number_input("Min ansatte", min_value=0, value=0, step=1)
+        with col2:
+            max_ansatte = st.number_input("Max ansatte", min_value=0, value=999_999, step=10)
+
+        # C) Segment (bransjeklynger via NACE)
+        st.subheader("Segment (bransjeklynger)")
+        use_kontor = st.checkbox("Kontor (IT/rådgivning/regnskap/salg)", value=False)
+        use_helse = st.checkbox("Helse & omsorg (skole/helse/barnehage)", value=False)
+        use_fysisk = st.checkbox("Fysiske virksomheter (bygg/industri/transport)", value=False)
+        use_topp = st.checkbox("Topprestasjon (advokat/konsulent/finans)", value=False)
+
+        # D) Sektor
+        st.subheader("Sektor")
+        sektor_priv = st.checkbox("Privat", value=True)
+        sektor_off = st.checkbox("Offentlig", value=True)
+
+        # E) Nettsidekrav
+        only_with_site = st.checkbox("Kun selskaper med nettside", value=True)
+
+        # F) Regnskapstall (krever ett API-kall pr selskap)
+        use_regnskap = st.checkbox("Berik med regnskapstall (årsresultat/lønn)", value=False)
+        if st.button("Tøm regnskaps-cache"):
+            shutil.rmtree(REGN_CACHE_DIR, ignore_errors=True)
+            fetch_regnskap_for.clear()
+            st.toast("Regnskaps-cache tømt.")
+
+        st.divider()
+        st.subheader("Antall og oppførsel")
+        ønsket_antall = st.number_input("Hvor mange selskaper vil du hente?", min_value=1, value=500, step=50)
+        shuffle_every_run = st.checkbox("Nye (tilfeldige) selskaper ved hver kjøring", value=True)
+
+        st.session_state["filters"] = {
+            "kommunenummer": kommunenummer,
+            "min_ansatte": min_ansatte,
+            "max_ansatte": max_ansatte,
+            "segment_flags": (use_kontor, use_helse, use_fysisk, use_topp),
+            "sector_flags": (sektor_priv, sektor_off),
+            "only_with_site": only_with_site,
+            "use_regnskap": use_regnskap,
+            "ønsket_antall": ønsket_antall,
+            "shuffle_every_run": shuffle_every_run,
+        }
 
 # --- Hjelpefunksjoner ----------------------------------------------------------
 @st.cache_data(show_spinner=False)
 def fetch_page(params: dict) -> dict:
-    r = requests.get(ENHETS_API, params=params, timeout=30)
+    # Enhets-profilen settes per kall — regnskaps-endepunktene skal ha vanlig JSON
+    r = get_session().get(ENHETS_API, params=params, timeout=30, headers={"Accept": ENHETS_ACCEPT})
     r.raise_for_status()
-    return r.json()
+    # orjson (C-utvidelse) parser de store sidene flere ganger raskere enn stdlib json
+    return orjson.loads(r.content)
 
-def build_params(page:int, size:int, kommunenummer=None, min_ansatte=None, max_ansatte=None, sort=None) -> dict:
+def build_params(page:int, size:int, kommunenummer=None, min_ansatte=None, max_ansatte=None,
+                 sort=None, nace_prefixes=None, orgforms=None) -> dict:
     p = {"page": page, "size": size}
     if kommunenummer:
         p["kommunenummer"] = ",".join(kommunenummer)
@@ -103,88 +207,171 @@ def build_params(page:int, size:int, kommunenummer=None, min_ansatte=None, max_a
         p["tilAntallAnsatte"] = max_ansatte
     if sort:
         p["sort"] = sort
+    if nace_prefixes:
+        # Wildcard-form: "62*" matcher alle underkoder av prefikset hos Brreg
+        p["naeringskode"] = ",".join(f"{pfx}*" for pfx in nace_prefixes)
+    if orgforms:
+        p["organisasjonsform"] = ",".join(orgforms)
     return p
 
-def nace_matches(prefixes:list[str], codes:list[str]) -> bool:
-    if not prefixes:
-        return True
-    if not codes:
-        return False
-    return any(any(code.startswith(p) for p in prefixes) for code in codes)
-
-def segment_hits(codes:list[str]) -> dict:
-    return {
-        "Kontor": nace_matches(KONTOR_NACE_PREFIXES, codes),
-        "Helse/omsorg": nace_matches(HELSE_NACE_PREFIXES, codes),
-        "Fysisk": nace_matches(FYSISK_NACE_PREFIXES, codes),
-        "Topprestasjon": nace_matches(TOPP_NACE_PREFIXES, codes),
-    }
-
-def classify_segment(codes:list[str]) -> str:
-    hits = [name for name, ok in segment_hits(codes).items() if ok]
-    if not hits:
-        return "Annet"
-    return ", ".join(hits)  # viser alle segmenter som gjelder
-
-def infer_sector(enhet:dict) -> str:
-    # Bruk institusjonell sektorkode hvis mulig, ellers orgform-heuristikk
-    sekt = (enhet.get("institusjonellSektorkode") or {}).get("kode")
-    if sekt and str(sekt).startswith("6"):
-        return "Offentlig"
-    orgform_kode = ((enhet.get("organisasjonsform") or {}).get("kode") or "").upper()
-    if orgform_kode in PUBLIC_ORGFORM:
-        return "Offentlig"
-    return "Privat"
-
-def has_website(url:str|None) -> bool:
-    return bool(url and url.strip() and len(url.strip()) > 3)
-
-def normalize_enhet_rows(data: dict) -> list[dict]:
-    rows = []
-    for e in data.get("_embedded", {}).get("enheter", []):
-        addr = e.get("forretningsadresse") or {}
-        orgf = e.get("organisasjonsform") or {}
-        nk1  = (e.get("naeringskode1") or {}).get("kode")
-        nk2  = (e.get("naeringskode2") or {}).get("kode")
-        nk3  = (e.get("naeringskode3") or {}).get("kode")
-        nace_codes = [c for c in [nk1, nk2, nk3] if c]
-        seg_label = classify_segment(nace_codes)
-        rows.append({
-            "orgnr": e.get("organisasjonsnummer"),
-            "navn": e.get("navn"),
-            "hjemmeside": e.get("hjemmeside"),
-            "kommune": addr.get("kommune"),
-            "kommunenr": addr.get("kommunenummer"),
-            "ansatte": e.get("antallAnsatte"),
-            "orgform": orgf.get("kode"),
-            "nace_codes": nace_codes,
-            "segment_label": seg_label,
-            "sektor": infer_sector(e),
-        })
-    return rows
-
-def pass_segment_filter(row:dict, use_kontor:bool, use_helse:bool, use_fysisk:bool, use_topp:bool) -> bool:
-    # Ingen segment-bokser huket => ikke filtrer
-    if not (use_kontor or use_helse or use_fysisk or use_topp):
-        return True
-    # La raden slippe gjennom hvis den treffer minst ett valgt segment
-    codes = row.get("nace_codes") or []
-    hits = segment_hits(codes)
-    return (
-        (use_kontor and hits["Kontor"])
-        or (use_helse and hits["Helse/omsorg"])
-        or (use_fysisk and hits["Fysisk"])
-        or (use_topp and hits["Topprestasjon"])
-    )
-
-def pass_sector_filter(row:dict, sektor_priv:bool, sektor_off:bool) -> bool:
-    if sektor_priv and sektor_off:
-        return True
-    if not (sektor_priv or sektor_off):
-        return True
-    return ((row["sektor"] == "Privat" and sektor_priv) or
-            (row["sektor"] == "Offentlig" and sektor_off))
-
+# json_normalize-stier → interne kolonnenavn
+_ENHET_COLS = {
+    "organisasjonsnummer": "orgnr",
+    "navn": "navn",
+    "hjemmeside": "hjemmeside",
+    "forretningsadresse.kommune": "kommune",
+    "forretningsadresse.kommunenummer": "kommunenr",
+    "antallAnsatte": "ansatte",
+    "organisasjonsform.kode": "orgform",
+    "institusjonellSektorkode.kode": "sekt_kode",
+}
+_NACE_COLS = ["naeringskode1.kode", "naeringskode2.kode", "naeringskode3.kode"]
+
+def page_frame(enheter: list[dict]) -> pd.DataFrame:
+    """Bygg en kolonnebasert DataFrame direkte fra enhets-JSON, uten per-rad dicts."""
+    if not enheter:
+        return pd.DataFrame()
+    raw = pd.json_normalize(enheter, sep=".", max_level=2)
+    df = pd.DataFrame(index=raw.index)
+    for src, dst in _ENHET_COLS.items():
+        df[dst] = raw[src] if src in raw.columns else None
+    for src, dst in zip(_NACE_COLS, ("nk1", "nk2", "nk3")):
+        df[dst] = raw[src] if src in raw.columns else None
+    return df
+
+def segment_bits(df: pd.DataFrame) -> pd.Series:
+    """Én heltalls-bitmaske per rad: OR av NACE2_BITS-oppslag for nk1–nk3."""
+    bits = pd.Series(0, index=df.index)
+    for col in ("nk1", "nk2", "nk3"):
+        bits |= df[col].str[:2].map(NACE2_BITS).fillna(0).astype(int)
+    return bits
+
+@functools.lru_cache(maxsize=None)
+def _label_for_bits(bits: int) -> str:
+    """Bitmaske → sammenslått etikett, f.eks. 0b1001 → \"Kontor, Topprestasjon\"."""
+    navn = [navn for i, (navn, _) in enumerate(SEGMENTS) if bits & (1 << i)]
+    return ", ".join(navn) if navn else "Annet"
+
+def classify_and_filter(df: pd.DataFrame,
+                        segment_flags: tuple[bool, bool, bool, bool],
+                        sector_flags: tuple[bool, bool]) -> pd.DataFrame:
+    """Vektorisert segment-/sektor-klassifisering + filtrering av en side-bunt."""
+    if df.empty:
+        return df
+
+    # Sektor først — den er én billig maske, og rader som ryker her slipper
+    # hele segmentarbeidet.
+    # Brreg leverer orgform-koder i versaler allerede, så ingen .str.upper()-pass.
+    # Sektorkoden sammenlignes på første tegn uten astype(str)-kopi av kolonnen;
+    # manglende koder blir NaN i slicen og dermed False i sammenligningen.
+    off_mask = ((df["sekt_kode"].str[:1] == "6")
+                | df["orgform"].fillna("").isin(PUBLIC_ORGFORM))
+    df["sektor"] = np.where(off_mask, "Offentlig", "Privat")
+
+    # Begge eller ingen sektor-bokser => ikke filtrer
+    priv_ok, off_ok = sector_flags
+    if priv_ok != off_ok:
+        df = df[off_mask if off_ok else ~off_mask]
+        if df.empty:
+            return df
+
+    bits = segment_bits(df)
+    # Ingen segment-bokser huket => ikke filtrer; ellers minst ett valgt segment
+    wanted_mask = sum(1 << i for i, flag in enumerate(segment_flags) if flag)
+    if wanted_mask:
+        df = df[(bits & wanted_mask) != 0]
+        if df.empty:
+            return df
+
+    # Etiketter kun for de overlevende radene; maks 16 ulike bitmasker
+    df["segment_label"] = bits.loc[df.index].map(_label_for_bits)
+    return df
+
+def iter_filtered_frames(limit:int,
+                         kommunenummer=None,
+                         min_ansatte=None, max_ansatte=None,
+                         sort:str|None=None,
+                         segment_flags:tuple[bool,bool,bool,bool]=(False,False,False,False),
+                         sector_flags:tuple[bool,bool]=(True,True),
+                         only_with_site:bool=True,
+                         page_size:int=PAGE_SIZE):
+    """Lat generator: yield'er først totalElements, deretter én filtrert frame
+    per side med treff, og stopper så snart 'limit' rader er samlet.
+
+    Holdes adskilt fra det memoiserte fetch_until_limit, så en konsument som
+    vil rendre batcher inkrementelt kan iterere direkte over denne.
+    """
+    # Push segmentvalget ned i API-spørringen så serveren slipper å sende rader vi
+    # uansett forkaster. De lokale maskene beholdes som sikkerhetsnett for treff
+    # på naeringskode2/3 som API-et ikke kan uttrykke.
+    nace_prefixes = sorted({p for (_, prefs), flag in zip(SEGMENTS, segment_flags) if flag
+                            for p in prefs}) or None
+    # Kun "Offentlig" huket => be API-et bare om de offentlige orgformene.
+    # (Motsatt vei finnes ikke noe ekskluderings-parameter; privat filtreres lokalt.)
+    priv_ok, off_ok = sector_flags
+    orgforms = sorted(PUBLIC_ORGFORM) if (off_ok and not priv_ok) else None
+
+    def _kept(data) -> pd.DataFrame:
+        """Filtrer én side kolonnevis til de radene som skal beholdes."""
+        df = page_frame(data.get("_embedded", {}).get("enheter", []))
+        if only_with_site and not df.empty:
+            # Nettsidefilteret som én C-pass over kolonnen, ikke strip()/len() per rad
+            df = df[df["hjemmeside"].fillna("").str.strip().str.len() > 3]
+        if df.empty:
+            return df
+        return classify_and_filter(df, segment_flags, sector_flags)
+
+    # Første side synkront for å lese totalPages/totalElements.
+    # (Side 0 er st.cache_data-et, så denne proben er gratis ved gjentatte kall.)
+    first = fetch_page(build_params(0, page_size, kommunenummer, min_ansatte, max_ansatte, sort,
+                                    nace_prefixes=nace_prefixes, orgforms=orgforms))
+    meta = first.get("page", {}) or {}
+    total_elements = meta.get("totalElements", 0)
+    total_pages = meta.get("totalPages", 1)
+    yield total_elements
+
+    # Finnes det færre treff enn brukeren ba om, er det taket — ikke jag
+    # gjennom alle sidene etter rader som ikke eksisterer
+    hard_cap = min(limit, total_elements)
+    n_kept = 0
+
+    kept = _kept(first)
+    if not kept.empty:
+        n_kept += len(kept)
+        yield kept
+    if n_kept >= hard_cap:
+        return
+
+    # Resten av sidene prefetches i puljer; resultatene flettes i sidenes rekkefølge.
+    # fetch_page er cache'et, så gjentatte kjøringer koster ingenting ekstra.
+    done = False
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as ex:
+        page = 1
+        while not done and page < total_pages:
+            batch = range(page, min(page + PAGE_WORKERS, total_pages))
+            futures = [ex.submit(fetch_page,
+                                 build_params(p, page_size, kommunenummer, min_ansatte,
+                                              max_ansatte, sort,
+                                              nace_prefixes=nace_prefixes, orgforms=orgforms))
+                       for p in batch]
+            for fut in futures:
+                if done:
+                    fut.cancel()  # sider som ennå ikke har startet droppes
+                    continue
+                kept = _kept(fut.result())
+                if not kept.empty:
+                    n_kept += len(kept)
+                    yield kept
+                if n_kept >= hard_cap:
+                    done = True
+            page = batch.stop
+
+# Hele det filtrerte resultatet memoiseres per filter-nøkkel (disk-persistent,
+# 1 t TTL), så identiske søk er et rent cache-treff — selv etter server-restart.
+# Shuffle skjer hos kallstedet, ETTER cache-grensen, så "nye tilfeldige selskaper"
+# ikke tvinger frem nye API-kall. (Inkrementell visning rett fra generatoren ville
+# omgått denne cachen — derfor konsumeres den samlet her.)
+@st.cache_data(ttl=3600, persist="disk", max_entries=64, show_spinner=False)
 def fetch_until_limit(limit:int,
                       kommunenummer=None,
                       min_ansatte=None, max_ansatte=None,
@@ -193,44 +380,174 @@ def fetch_until_limit(limit:int,
                       sector_flags:tuple[bool,bool]=(True,True),
                       only_with_site:bool=True,
                       page_size:int=PAGE_SIZE) -> tuple[pd.DataFrame, int]:
-    """Hent side for side og filtrer lokalt til vi har 'limit' rader."""
-    want_kontor, want_helse, want_fysisk, want_topp = segment_flags
-    priv_ok, off_ok = sector_flags
-
-    page = 0
-    collected = []
-    total_elements = None
-    total_pages = None
-
-    while len(collected) < limit:
-        params = build_params(page, page_size, kommunenummer, min_ansatte, max_ansatte, sort)
-        data = fetch_page(params)
-
-        if total_elements is None:
-            meta = data.get("page", {}) or {}
-            total_elements = meta.get("totalElements", 0)
-            total_pages = meta.get("totalPages", 1)
-
-        rows = normalize_enhet_rows(data)
-        for r in rows:
-            if only_with_site and not has_website(r["hjemmeside"]):
-                continue
-            if not pass_segment_filter(r, want_kontor, want_helse, want_fysisk, want_topp):
-                continue
-            if not pass_sector_filter(r, priv_ok, off_ok):
-                continue
-            collected.append(r)
-            if len(collected) >= limit:
-                break
-
-        page += 1
-        if total_pages is not None and page >= total_pages:
-            break
-
-    df = pd.DataFrame(collected)
+    """Konsumer batch-generatoren til ett samlet, memoisert resultat."""
+    it = iter_filtered_frames(limit, kommunenummer, min_ansatte, max_ansatte, sort,
+                              segment_flags, sector_flags, only_with_site, page_size)
+    total_elements = next(it)
+    frames = list(it)
+    df = pd.concat(frames, ignore_index=True).head(limit) if frames else pd.DataFrame()
     return df, (total_elements or len(df))
 
+# --- Regnskapsregisteret (berikelse) ------------------------------------------
+def _regn_get(orgnr: str, base: str, param: str | None) -> requests.Response:
+    """Ett GET mot et regnskaps-endepunkt; param=None betyr orgnr i URL-stien."""
+    if param is None:
+        return get_session().get(f"{base}/{orgnr}", timeout=20)
+    return get_session().get(base, params={param: orgnr}, timeout=20)
+
+@st.cache_resource(show_spinner=False)
+def resolve_regn_endpoint(probe_orgnr: str) -> tuple[str, str | None] | None:
+    """Prob endepunkt-kandidatene én gang og husk hvilken som faktisk svarer.
+
+    Returnerer (base, param) for første kandidat som gir 200 + gyldig JSON,
+    ellers None. Memoiseres, så de resterende oppslagene slipper døde URL-er.
+    """
+    for base, param in REGN_ENDPOINT_CANDIDATES:
+        try:
+            r = _regn_get(probe_orgnr, base, param)
+            if r.status_code == 200:
+                orjson.loads(r.content)
+                return (base, param)
+        except (requests.RequestException, ValueError):
+            continue
+    return None
+
+@st.cache_data(show_spinner=False)
+def fetch_regnskap_for(orgnr: str, endpoint: tuple[str, str | None]) -> dict | None:
+    """Hent regnskaps-JSON for ett orgnr, med disk-cache foran HTTP-kallet."""
+    cache_path = REGN_CACHE_DIR / f"{orgnr}.json"
+    try:
+        if cache_path.exists() and time.time() - cache_path.stat().st_mtime < REGN_CACHE_TTL:
+            return orjson.loads(cache_path.read_bytes())
+    except (OSError, ValueError):
+        pass  # korrupt/utilgjengelig cache-fil — hent på nytt
+
+    base, param = endpoint
+    try:
+        r = _regn_get(orgnr, base, param)
+        if r.status_code == 200:
+            payload = orjson.loads(r.content)
+            try:
+                REGN_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                tmp_path = cache_path.with_suffix(".tmp")
+                tmp_path.write_bytes(orjson.dumps(payload))
+                os.replace(tmp_path, cache_path)  # atomisk — aldri halvskrevne filer
+            except OSError:
+                pass
+            return payload
+    except requests.RequestException:
+        pass
+    return None
+
+# Kjente plasseringer av nøkkeltallene i regnskaps-JSON; prøves direkte før
+# den generelle traverseringen. Hint-settene har både aksentuert og ascii-form
+# klargjort én gang, så traverseringen slipper aksent-stripping per nøkkel.
+_RES_PATHS = [
+    ("resultatregnskapResultat", "aarsresultat"),
+    ("resultat", "aarsresultat"),
+    ("aarsresultat",),
+]
+_LONN_PATHS = [
+    ("resultatregnskapResultat", "driftskostnad", "loennskostnad"),
+    ("resultatregnskapResultat", "driftskostnad", "lonnskostnad"),
+    ("driftskostnad", "loennskostnad"),
+]
+_RES_HINTS = frozenset({"aarsresultat", "arsresultat", "årsresultat"})
+_LONN_HINTS = frozenset({"lonnskostnad", "loennskostnad", "lønnskostnad"})
+
+def _get_path(payload: dict, path: tuple[str, ...]) -> float | None:
+    """Slå opp en kjent nøkkel-sti; None hvis stien mangler eller ikke er numerisk."""
+    node = payload
+    for key in path:
+        if not isinstance(node, dict):
+            return None
+        node = node.get(key)
+    return float(node) if isinstance(node, (int, float)) else None
+
+def _walk_first(node, hints: frozenset[str]) -> float | None:
+    """Én rekursiv pass som stopper ved første numeriske verdi under en hint-nøkkel."""
+    if isinstance(node, dict):
+        for k, v in node.items():
+            key = k.lower()
+            if isinstance(v, (int, float)) and any(h in key for h in hints):
+                return float(v)
+            found = _walk_first(v, hints)
+            if found is not None:
+                return found
+    elif isinstance(node, list):
+        for v in node:
+            found = _walk_first(v, hints)
+            if found is not None:
+                return found
+    return None
+
+def _extract(payload) -> tuple[float | None, float | None]:
+    """Trekk ut (årsresultat, lønnskostnader) fra et regnskaps-payload."""
+    if isinstance(payload, list):  # API-et kan returnere liste av regnskapsår
+        payload = payload[0] if payload else None
+    if not payload:
+        return (None, None)
+    aarsres = next((v for p in _RES_PATHS if (v := _get_path(payload, p)) is not None), None)
+    if aarsres is None:
+        aarsres = _walk_first(payload, _RES_HINTS)
+    lonn = next((v for p in _LONN_PATHS if (v := _get_path(payload, p)) is not None), None)
+    if lonn is None:
+        lonn = _walk_first(payload, _LONN_HINTS)
+    return (aarsres, lonn)
+
+def enrich_with_financials(df: pd.DataFrame, max_calls: int = 2000) -> pd.DataFrame:
+    """Slå opp regnskapstall parallelt og legg på kolonner for resultat/lønn."""
+    if df.empty:
+        return df
+    to_lookup = list(df["orgnr"].dropna().unique())[:max_calls]
+    fin_map: dict[str, tuple[float | None, float | None]] = {}
+    endpoint = resolve_regn_endpoint(to_lookup[0])
+    if endpoint is not None:
+        with ThreadPoolExecutor(max_workers=REGN_MAX_WORKERS) as ex:
+            futures = {ex.submit(fetch_regnskap_for, o, endpoint): o for o in to_lookup}
+            for fut in as_completed(futures):
+                try:
+                    fin_map[futures[fut]] = _extract(fut.result())
+                except Exception:
+                    fin_map[futures[fut]] = (None, None)
+
+    # Én merge i stedet for copy + to map-kolonner: ett nytt DataFrame totalt
+    fin_df = pd.DataFrame.from_records(
+        [(o, *vals) for o, vals in fin_map.items()],
+        columns=["orgnr", "årsresultat", "lønnskostnader"],
+    )
+    df = df.merge(fin_df, on="orgnr", how="left")
+
+    ansatte = pd.to_numeric(df["ansatte"], errors="coerce")
+    lonn = pd.to_numeric(df["lønnskostnader"], errors="coerce")
+    df["lønn pr ansatt"] = np.where((ansatte > 0) & lonn.notna(), lonn / ansatte, np.nan)
+    return df
+
+# --- Nedlastings-serialisering -------------------------------------------------
+@st.cache_data(show_spinner=False)
+def df_to_csv_bytes(df: pd.DataFrame) -> bytes:
+    # Skriv rett til buffer — unngår den mellomliggende str-en som dobler minnetoppen
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding="utf-8")
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False)
+def df_to_xlsx_bytes(df: pd.DataFrame) -> bytes:
+    buf = io.BytesIO()
+    # write_only: radene streames rett til zip-arkivet, intet celle-grid i minnet
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Enheter")
+    ws.append(list(df.columns))
+    for row in df.where(df.notna(), None).itertuples(index=False, name=None):
+        ws.append(row)
+    wb.save(buf)
+    return buf.getvalue()
+
 # --- Kjør søk + visning -------------------------------------------------------
+# Fragmentet kalles her, etter at fetch_regnskap_for m.fl. er definert, slik at
+# knappe-callbacks i sidebaren kan nå dem.
+render_sidebar()
+
 colA, colB = st.columns([1, 4])
 with colA:
     run = st.button("Hent selskaper", type="primary")
@@ -238,62 +555,83 @@ with colB:
     st.caption("Fast API-side-størrelse: 200. Tips: begrens med filtre for raskere svar.")
 
 if run:
+    f = st.session_state["filters"]
+    use_regnskap = f["use_regnskap"]
     with st.spinner("Henter fra Enhetsregisteret..."):
         base_df, total = fetch_until_limit(
-            limit=ønsket_antall,
-            kommunenummer=kommunenummer or None,
-            min_ansatte=min_ansatte or None,
-            max_ansatte=max_ansatte or None,
+            limit=f["ønsket_antall"],
+            kommunenummer=f["kommunenummer"] or None,
+            min_ansatte=f["min_ansatte"] or None,
+            max_ansatte=f["max_ansatte"] or None,
             sort=None,
-            segment_flags=(use_kontor, use_helse, use_fysisk, use_topp),
-            sector_flags=(sektor_priv, sektor_off),
-            only_with_site=only_with_site,
+            segment_flags=f["segment_flags"],
+            sector_flags=f["sector_flags"],
+            only_with_site=f["only_with_site"],
             page_size=PAGE_SIZE,
         )
 
-    if shuffle_every_run and not base_df.empty:
-        base_df = base_df.sample(frac=1.0, random_state=None).reset_index(drop=True)
+    if f["shuffle_every_run"] and not base_df.empty:
+        # Stokking må skje her, ETTER cache-grensen i fetch_until_limit — ellers
+        # ville én tilfeldig rekkefølge fryses inn i det memoiserte resultatet.
+        # take på en permutasjonsindeks gjør jobben uten sample()-maskineriet.
+        base_df = base_df.take(np.random.permutation(len(base_df))).reset_index(drop=True)
+
+    if use_regnskap and not base_df.empty:
+        with st.spinner("Henter regnskapstall..."):
+            base_df = enrich_with_financials(base_df)
 
     # Sett opp visning/kolonner
-    out_df = base_df[["navn", "hjemmeside", "kommune", "ansatte", "segment_label", "sektor"]].rename(columns={
+    vis_kolonner = ["navn", "hjemmeside", "kommune", "ansatte", "segment_label", "sektor"]
+    if use_regnskap:
+        vis_kolonner += ["årsresultat", "lønnskostnader", "lønn pr ansatt"]
+    out_df = base_df[[k for k in vis_kolonner if k in base_df.columns]].rename(columns={
         "navn": "Selskapsnavn",
         "hjemmeside": "Nettside",
         "kommune": "Kommune",
         "ansatte": "Antall ansatte",
         "segment_label": "Segment",
         "sektor": "Sektor",
+        "årsresultat": "Årsresultat",
+        "lønnskostnader": "Lønnskostnader",
+        "lønn pr ansatt": "Lønn pr ansatt",
     })
 
     # Statuslinje
     tot_pages_guess = math.ceil(total / PAGE_SIZE)
     active_segments = ", ".join(
-        [name for name, flag in [
-            ("Kontor", use_kontor),
-            ("Helse", use_helse),
-            ("Fysisk", use_fysisk),
-            ("Topprestasjon", use_topp),
-        ] if flag]
+        [name for name, flag in zip(("Kontor", "Helse", "Fysisk", "Topprestasjon"),
+                                    f["segment_flags"]) if flag]
     ) or "Ingen"
-    st.markdown(
+    sektor_priv, sektor_off = f["sector_flags"]
+    status_md = (
         f"**Totalt treff hos Brreg:** {total:,}  •  **Returnert (etter filtre):** {len(out_df):,}  "
         f"•  **Est. sider:** {tot_pages_guess}  "
-        f"•  **Kun med nettside:** {'Ja' if only_with_site else 'Nei'}  "
+        f"•  **Kun med nettside:** {'Ja' if f['only_with_site'] else 'Nei'}  "
         f"•  **Segmentfilter:** {active_segments}  "
         f"•  **Sektor:** "
         f"{'Privat' if sektor_priv else ''}{'/' if sektor_priv and sektor_off else ''}{'Offentlig' if sektor_off else ''}"
     )
 
-    st.dataframe(out_df, width="stretch", hide_index=True)
+    # Resultatet stashes i session_state så visning/nedlasting overlever reruns
+    st.session_state["out_df"] = out_df
+    st.session_state["status_md"] = status_md
+    # xlsx bygges i bakgrunnen mens brukeren ser på tabellen; cache'en gjør at
+    # samme resultat aldri serialiseres to ganger
+    st.session_state["_xlsx_future"] = SERIALIZE_POOL.submit(df_to_xlsx_bytes, out_df)
 
-    # Nedlasting: CSV / Excel
-    csv_bytes = out_df.to_csv(index=False).encode("utf-8")
-    st.download_button("⬇️ Last ned som CSV", data=csv_bytes, file_name="potential_livities.csv", mime="text/csv")
+if "out_df" in st.session_state:
+    out_df = st.session_state["out_df"]
+    st.markdown(st.session_state["status_md"])
+    st.dataframe(out_df, width="stretch", hide_index=True)
 
-    excel_buf = io.BytesIO()
-    with pd.ExcelWriter(excel_buf, engine="xlsxwriter") as writer:
-        out_df.to_excel(writer, index=False, sheet_name="Enheter")
+    # Nedlasting: CSV er billig og serialiseres (cache'et) med en gang; xlsx er
+    # startet i bakgrunnen etter søket og er normalt ferdig før noen rekker å klikke
+    st.download_button("⬇️ Last ned som CSV", data=df_to_csv_bytes(out_df),
+                       file_name="potential_livities.csv", mime="text/csv")
+    xlsx_future = st.session_state.get("_xlsx_future")
+    xlsx_bytes = xlsx_future.result() if xlsx_future is not None else df_to_xlsx_bytes(out_df)
     st.download_button("⬇️ Last ned som Excel (.xlsx)",
-                       data=excel_buf.getvalue(),
+                       data=xlsx_bytes,
                        file_name="potential_livities.xlsx",
                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 